@@ -1,13 +1,21 @@
 const express = require('express');
 const axios = require('axios');
+const http = require('http');
+const https = require('https');
+const cluster = require('cluster');
 const NodeRSA = require('node-rsa');
 const sqlite3 = require('sqlite3').verbose();
 const { open } = require('sqlite');
 const crypto = require('crypto');
-const { v4: uuidv4 } = require('uuid');
+const { pipeline } = require('stream');
 
 const app = express();
-app.use(express.json());
+// 保留原始请求体，聊天请求可直接转发而无需重新序列化
+app.use(express.json({
+    verify: (req, res, buf) => {
+        req.rawBody = buf;
+    }
+}));
 
 // 环境变量配置
 const BASE_URL = process.env.BASE_URL || 'https://g4f.dev';
@@ -19,6 +27,13 @@ const KEY_EXPIRY_MINUTES = parseInt(process.env.KEY_EXPIRY_MINUTES || '60');
 const MODEL_CACHE_DAYS = parseInt(process.env.MODEL_CACHE_DAYS || '7');
 const PORT = process.env.PORT || 3000;
 const USE_SQLITE = process.env.USE_SQLITE !== 'false';
+const WORKERS = parseInt(process.env.WORKERS || '1');
+const KEY_EXPIRY_MS = KEY_EXPIRY_MINUTES * 60 * 1000;
+const RSA_KEY_CACHE_SIZE = 8;
+const FILE_URL_CACHE_SIZE = 4096;
+const WORKER_RESTART_DELAY_MS = 1000;
+// 后台替换keys的检查周期，不超过 setInterval 的最大延迟（超出后 Node 会退化为 1ms）
+const KEY_RENEW_INTERVAL_MS = Math.min(KEY_EXPIRY_MS / 4, 2 ** 31 - 1);
 
 // User Agent 配置
 const USER_AGENTS = {
@@ -29,15 +44,24 @@ const USER_AGENTS = {
     'Edge-Windows': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36 Edg/120.0.0.0'
 };
 
+// 共享的上游 HTTP 客户端，复用 keep-alive 连接，避免每个请求重新握手
+// 不限制并发连接数（流式响应会长时间占用连接），按 LIFO 复用空闲连接，让热连接优先被使用
+const agentOptions = { keepAlive: true, maxFreeSockets: 50, scheduling: 'lifo' };
+const httpAgent = new http.Agent(agentOptions);
+const httpsAgent = new https.Agent(agentOptions);
+const upstream = axios.create({ httpAgent, httpsAgent, timeout: 60000 });
+
 // 内存存储
 let memoryStore = {
     keys: [],
     models: null,
+    modelsById: new Map(),
     modelsExpiry: null
 };
 
 // 数据库初始化
 let db = null;
+let statements = {};
 
 async function initDatabase() {
     if (!USE_SQLITE) {
@@ -51,6 +75,17 @@ async function initDatabase() {
             driver: sqlite3.Database
         });
 
+        // WAL + synchronous=NORMAL 避免每次写入都 fsync；
+        // busy_timeout 让多个连接并发写入时等待锁而不是直接报 SQLITE_BUSY
+        await db.exec(`
+            PRAGMA busy_timeout = 5000;
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            PRAGMA temp_store = MEMORY;
+            PRAGMA cache_size = -10000;
+            PRAGMA mmap_size = 268435456;
+        `);
+
         await db.exec(`
             CREATE TABLE IF NOT EXISTS azure_keys (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -69,6 +104,14 @@ async function initDatabase() {
             )
         `);
 
+        // 预编译高频语句，避免每次写入重新解析 SQL
+        statements = {
+            insertKey: await db.prepare(
+                'INSERT INTO azure_keys (key, ua_name, created_at, expires_at) VALUES (?, ?, ?, ?)'
+            ),
+            deleteExpiredKeys: await db.prepare('DELETE FROM azure_keys WHERE expires_at <= ?')
+        };
+
         console.log('Database initialized');
     } catch (error) {
         console.error('Database initialization failed, falling back to memory storage:', error);
@@ -76,62 +119,152 @@ async function initDatabase() {
     }
 }
 
+// 后台写入串行排队执行，keys 与模型缓存的写入不会相互穿插
+let dbWrites = Promise.resolve();
+
+function queueWrite(label, write) {
+    dbWrites = dbWrites.then(write).catch(error => {
+        console.error(`Failed to persist ${label}:`, error.message);
+    });
+}
+
+async function closeDatabase() {
+    if (!db) return;
+    
+    // 停止接收新的写入，并等待已排队的写入完成后再关闭
+    const handle = db;
+    db = null;
+    await dbWrites;
+    
+    for (const statement of Object.values(statements)) {
+        await statement.finalize();
+    }
+    await handle.close();
+}
+
+// 每个 key 的上游请求头只构造一次，随 key 一起缓存
+function buildKeyHeaders(key, uaName) {
+    return {
+        'Content-Type': 'application/json',
+        'Authorization': `Bearer ${key}`,
+        'User-Agent': USER_AGENTS[uaName]
+    };
+}
+
 // Azure Key 管理器
 class AzureKeyManager {
-    async getKeys() {
+    constructor() {
+        // 按 PEM 缓存解析后的公钥，服务端公钥很少轮换
+        this.rsaKeys = new Map();
+        this.refilling = null;
+    }
+
+    // 启动时把数据库中未过期的 keys 加载到内存
+    async loadKeys() {
+        if (!db) return;
+        
         const now = Date.now();
+        await statements.deleteExpiredKeys.run(now);
+        const rows = await db.all(
+            'SELECT key, ua_name, created_at, expires_at FROM azure_keys WHERE expires_at > ? ORDER BY expires_at',
+            now
+        );
+        memoryStore.keys = rows.map(row => ({ ...row, headers: buildKeyHeaders(row.key, row.ua_name) }));
+    }
+
+    // 内存为唯一数据源，数据库写入在后台完成，不阻塞请求
+    persist(statement, ...params) {
+        if (!db) return;
         
-        if (db) {
-            // 删除过期的keys
-            await db.run('DELETE FROM azure_keys WHERE expires_at < ?', now);
-            
-            // 获取有效的keys
-            const keys = await db.all('SELECT * FROM azure_keys WHERE expires_at > ?', now);
-            return keys;
-        } else {
-            // 内存存储
-            memoryStore.keys = memoryStore.keys.filter(k => k.expires_at > now);
-            return memoryStore.keys;
+        queueWrite('Azure keys', () => statement.run(...params));
+    }
+
+    getKeys() {
+        const now = Date.now();
+        const keys = memoryStore.keys;
+        
+        // keys 按过期时间升序排列（loadKeys 排序加载，addKey 有序插入），只需从队首删除过期的keys
+        let expired = 0;
+        while (expired < keys.length && keys[expired].expires_at <= now) {
+            expired++;
+        }
+        if (expired > 0) {
+            keys.splice(0, expired);
+            this.persist(statements.deleteExpiredKeys, now);
         }
+        
+        return keys;
     }
 
-    async addKey(key, uaName) {
+    addKey(key, uaName) {
         const now = Date.now();
-        const expiresAt = now + (KEY_EXPIRY_MINUTES * 60 * 1000);
+        const expiresAt = now + KEY_EXPIRY_MS;
         
         const keyData = {
             key: key,
             ua_name: uaName,
             created_at: now,
-            expires_at: expiresAt
+            expires_at: expiresAt,
+            headers: buildKeyHeaders(key, uaName)
         };
 
-        if (db) {
-            await db.run(
-                'INSERT INTO azure_keys (key, ua_name, created_at, expires_at) VALUES (?, ?, ?, ?)',
-                keyData.key, keyData.ua_name, keyData.created_at, keyData.expires_at
-            );
-        } else {
-            memoryStore.keys.push(keyData);
+        // 按过期时间插入到有序位置：数据库中可能有按旧 KEY_EXPIRY_MINUTES 生成的keys，
+        // 系统时钟也可能回拨，直接追加不能保证有序
+        const keys = memoryStore.keys;
+        let low = 0;
+        let high = keys.length;
+        while (low < high) {
+            const mid = (low + high) >> 1;
+            if (keys[mid].expires_at <= expiresAt) {
+                low = mid + 1;
+            } else {
+                high = mid;
+            }
         }
+        keys.splice(low, 0, keyData);
+        
+        this.persist(
+            statements.insertKey,
+            keyData.key, keyData.ua_name, keyData.created_at, keyData.expires_at
+        );
     }
 
     async ensureKeys() {
-        const keys = await this.getKeys();
-        const needed = MAX_KEYS - keys.length;
-        
-        if (needed > 0) {
-            console.log(`Generating ${needed} new Azure keys...`);
-            for (let i = 0; i < needed; i++) {
-                try {
-                    await this.generateNewKey();
-                } catch (error) {
-                    console.error('Failed to generate key:', error.message);
-                }
-            }
+        const keys = this.getKeys();
+        if (keys.length >= MAX_KEYS) return keys;
+        
+        await this.topUpKeys(MAX_KEYS - keys.length);
+        
+        return this.getKeys();
+    }
+
+    // 同一批生成的keys会同时过期，提前替换撑不到下一次检查的keys（留半个周期余量）
+    async renewKeys() {
+        const threshold = Date.now() + KEY_RENEW_INTERVAL_MS * 1.5;
+        const healthy = this.getKeys().filter(k => k.expires_at > threshold).length;
+        
+        if (healthy < MAX_KEYS) {
+            await this.topUpKeys(MAX_KEYS - healthy);
+        }
+    }
+
+    // 并发调用共享同一次补充，避免重复生成
+    topUpKeys(needed) {
+        if (!this.refilling) {
+            this.refilling = this.refillKeys(needed).finally(() => {
+                this.refilling = null;
+            });
         }
+        return this.refilling;
+    }
+
+    async refillKeys(needed) {
+        console.log(`Generating ${needed} new Azure keys...`);
         
-        return await this.getKeys();
+        // 并行生成，失败已在 generateNewKey 中记录
+        await Promise.allSettled(
+            Array.from({ length: needed }, () => this.generateNewKey())
+        );
     }
 
     async generateNewKey() {
@@ -142,7 +275,7 @@ class AzureKeyManager {
             const userAgent = USER_AGENTS[uaName];
 
             // 获取公钥
-            const response = await axios.post(`${BASE_URL}/backend-api/v2/public-key`, {}, {
+            const response = await upstream.post(`${BASE_URL}/backend-api/v2/public-key`, {}, {
                 headers: {
                     'User-Agent': userAgent
                 },
@@ -160,14 +293,11 @@ class AzureKeyManager {
             };
 
             // RSA加密
-            const key = new NodeRSA();
-            key.importKey(public_key, 'public');
-            key.setOptions({ encryptionScheme: 'pkcs1' });
-            
+            const key = this.getRsaKey(public_key);
             const encrypted = key.encrypt(JSON.stringify(payload), 'base64');
             
             // 保存key
-            await this.addKey(encrypted, uaName);
+            this.addKey(encrypted, uaName);
             
             console.log(`Generated new Azure key with UA: ${uaName}`);
             return encrypted;
@@ -177,8 +307,37 @@ class AzureKeyManager {
         }
     }
 
+    getRsaKey(publicKey) {
+        let key = this.rsaKeys.get(publicKey);
+        if (!key) {
+            key = new NodeRSA();
+            key.importKey(publicKey, 'public');
+            key.setOptions({ encryptionScheme: 'pkcs1' });
+            
+            // 公钥轮换后旧的缓存不再需要
+            if (this.rsaKeys.size >= RSA_KEY_CACHE_SIZE) {
+                this.rsaKeys.clear();
+            }
+            this.rsaKeys.set(publicKey, key);
+        }
+        return key;
+    }
+
     async getRandomKey() {
-        const keys = await this.ensureKeys();
+        let keys = this.getKeys();
+        
+        // 池未满时在后台补充，只有没有可用 key 时才等待生成
+        if (keys.length < MAX_KEYS) {
+            const refill = this.ensureKeys();
+            if (keys.length === 0) {
+                keys = await refill;
+            } else {
+                refill.catch(error => {
+                    console.error('Failed to refill Azure keys:', error.message);
+                });
+            }
+        }
+        
         if (keys.length === 0) {
             throw new Error('No valid Azure keys available');
         }
@@ -186,24 +345,26 @@ class AzureKeyManager {
         const randomKey = keys[Math.floor(Math.random() * keys.length)];
         return {
             key: randomKey.key,
-            userAgent: USER_AGENTS[randomKey.ua_name]
+            headers: randomKey.headers
         };
     }
 }
 
 const keyManager = new AzureKeyManager();
 
-// 模型缓存管理
+// 模型缓存管理，内存优先，数据库仅用于重启后恢复
 async function getModelsCache() {
     const now = Date.now();
     
+    if (memoryStore.modelsExpiry && memoryStore.modelsExpiry > now) {
+        return memoryStore.models;
+    }
+    
     if (db) {
         const cache = await db.get('SELECT * FROM models_cache WHERE expires_at > ? LIMIT 1', now);
         if (cache) {
-            return JSON.parse(cache.models);
-        }
-    } else {
-        if (memoryStore.modelsExpiry && memoryStore.modelsExpiry > now) {
+            setMemoryModels(JSON.parse(cache.models), cache.expires_at);
+            persistedModels = cache.models;
             return memoryStore.models;
         }
     }
@@ -211,19 +372,66 @@ async function getModelsCache() {
     return null;
 }
 
-async function setModelsCache(models) {
+function setMemoryModels(models, expiresAt) {
+    memoryStore.models = models;
+    memoryStore.modelsById = new Map(models.map(m => [m.id, m]));
+    memoryStore.modelsExpiry = expiresAt;
+}
+
+// 最近一次写入数据库的模型列表，内容未变化时无需重写
+let persistedModels = null;
+
+function setModelsCache(models) {
     const expiresAt = Date.now() + (MODEL_CACHE_DAYS * 24 * 60 * 60 * 1000);
     
+    setMemoryModels(models, expiresAt);
+    
     if (db) {
-        await db.run('DELETE FROM models_cache');
-        await db.run(
-            'INSERT INTO models_cache (id, models, expires_at) VALUES (1, ?, ?)',
-            JSON.stringify(models), expiresAt
-        );
-    } else {
-        memoryStore.models = models;
-        memoryStore.modelsExpiry = expiresAt;
+        const handle = db;
+        const data = JSON.stringify(models);
+        
+        // 后台写入数据库；模型列表未变化时只延长过期时间
+        queueWrite('models cache', async () => {
+            if (data === persistedModels) {
+                await handle.run('UPDATE models_cache SET expires_at = ? WHERE id = 1', expiresAt);
+            } else {
+                await handle.run(
+                    'INSERT OR REPLACE INTO models_cache (id, models, expires_at) VALUES (1, ?, ?)',
+                    data, expiresAt
+                );
+                persistedModels = data;
+            }
+        });
+    }
+}
+
+// 获取模型列表，缓存失效时合并并发请求，只向上游请求一次
+let modelsFetch = null;
+
+async function getModels() {
+    const models = await getModelsCache();
+    if (models) return models;
+    
+    if (!modelsFetch) {
+        modelsFetch = fetchModels().finally(() => {
+            modelsFetch = null;
+        });
     }
+    return modelsFetch;
+}
+
+async function fetchModels() {
+    const { headers } = await keyManager.getRandomKey();
+    
+    // 请求模型列表
+    const response = await upstream.get(`${BASE_URL}/api/Azure/models`, {
+        headers,
+        timeout: 30000
+    });
+    
+    const models = response.data.data;
+    setModelsCache(models);
+    return models;
 }
 
 // 鉴权中间件
@@ -241,10 +449,36 @@ function authenticate(req, res, next) {
     next();
 }
 
-// 处理文件URL
+// 图片结果流式响应中固定不变的片段
+const SSE_STOP_TAIL = ',"choices":[{"index":0,"delta":{"content":""},"finish_reason":"stop"}],"usage":{"prompt_tokens":0,"completion_tokens":0,"total_tokens":0}}\n\n';
+const SSE_DONE = 'data: [DONE]\n\n';
+
+// 生成聊天补全 ID，randomUUID 使用预取的随机数池，无需每次读取系统熵
+function generateId() {
+    return `chatcmpl-${crypto.randomUUID().replace(/-/g, '')}`;
+}
+
+// 处理文件URL，结果按原始 URL 缓存，流式响应中常有重复链接
+const fileUrlCache = new Map();
+
 function processFileUrl(url) {
     if (!url) return url;
     
+    let result = fileUrlCache.get(url);
+    if (result === undefined) {
+        result = buildFileUrl(url);
+        
+        // 超出容量时删除最早加入的条目
+        if (fileUrlCache.size >= FILE_URL_CACHE_SIZE) {
+            fileUrlCache.delete(fileUrlCache.keys().next().value);
+        }
+        fileUrlCache.set(url, result);
+    }
+    
+    return result;
+}
+
+function buildFileUrl(url) {
     // 处理相对路径
     if (url.startsWith('/media/') || url.startsWith('/thumbnail/')) {
         url = `${BASE_URL}${url}`;
@@ -258,54 +492,56 @@ function processFileUrl(url) {
     }
 }
 
-// 处理响应内容中的媒体链接
+// 处理响应内容中的媒体链接（audio/video 的 src 与 thumbnail）
+// 以字面量开头且没有嵌套量词，V8 可线性扫描，不会出现回溯爆炸
+const MEDIA_SRC_RE = /src="(\/(?:media|thumbnail)\/[^"]+)"/g;
+
 function processMediaLinks(content) {
-    if (!content) return content;
+    // 大部分内容不含相对媒体链接，先做子串检查跳过正则
+    if (!content || !content.includes('src="/')) return content;
     
-    // 处理 audio/video 标签中的 src
-    content = content.replace(/src="\/media\/([^"]+)"/g, (match, path) => {
-        const url = `${BASE_URL}/media/${path}`;
-        return `src="${processFileUrl(url)}"`;
-    });
+    return content.replace(MEDIA_SRC_RE, (match, path) => `src="${processFileUrl(path)}"`);
+}
+
+// 改写上游 SSE 数据中的媒体链接，保持原有的行和分帧
+function rewriteSseMedia(text) {
+    // 大部分数据块不含相对媒体链接，原样返回
+    if (!text.includes('src=\\"/')) return text;
     
-    // 处理 thumbnail 链接
-    content = content.replace(/src="\/thumbnail\/([^"]+)"/g, (match, path) => {
-        const url = `${BASE_URL}/thumbnail/${path}`;
-        return `src="${processFileUrl(url)}"`;
-    });
+    return text.split('\n').map(rewriteSseLine).join('\n');
+}
+
+function rewriteSseLine(line) {
+    if (!line.startsWith('data: ') || !line.includes('src=\\"/')) return line;
     
-    return content;
+    try {
+        const json = JSON.parse(line.substring(6));
+        if (json.choices) {
+            json.choices = json.choices.map(choice => {
+                if (choice.delta && choice.delta.content) {
+                    choice.delta.content = processMediaLinks(choice.delta.content);
+                }
+                return choice;
+            });
+        }
+        return `data: ${JSON.stringify(json)}`;
+    } catch (e) {
+        // 如果解析失败，原样输出
+        return line;
+    }
 }
 
 // GET /v1/models
 app.get('/v1/models', authenticate, async (req, res) => {
     try {
-        // 检查缓存
-        let models = await getModelsCache();
-        
-        if (!models) {
-            // 获取Azure key
-            const { key, userAgent } = await keyManager.getRandomKey();
-            
-            // 请求模型列表
-            const response = await axios.get(`${BASE_URL}/api/Azure/models`, {
-                headers: {
-                    'Content-Type': 'application/json',
-                    'Authorization': `Bearer ${key}`,
-                    'User-Agent': userAgent
-                },
-                timeout: 30000
-            });
-            
-            models = response.data.data;
-            await setModelsCache(models);
-        }
+        const models = await getModels();
         
         // 转换为OpenAI格式
+        const created = Math.floor(Date.now() / 1000);
         const openaiModels = models.map(model => ({
             id: model.id,
             object: 'model',
-            created: Math.floor(Date.now() / 1000),
+            created: created,
             owned_by: '',
             image: model.image || false,
             vision: model.vision || false,
@@ -328,28 +564,14 @@ app.post('/v1/chat/completions', authenticate, async (req, res) => {
         const { messages, stream = false, model } = req.body;
         
         // 获取模型信息
-        let models = await getModelsCache();
-        if (!models) {
-            const { key, userAgent } = await keyManager.getRandomKey();
-            const response = await axios.get(`${BASE_URL}/api/Azure/models`, {
-                headers: {
-                    'Content-Type': 'application/json',
-                    'Authorization': `Bearer ${key}`,
-                    'User-Agent': userAgent
-                },
-                timeout: 30000
-            });
-            models = response.data.data;
-            await setModelsCache(models);
-        }
-        
-        const modelInfo = models.find(m => m.id === model);
+        await getModels();
+        const modelInfo = memoryStore.modelsById.get(model);
         if (!modelInfo) {
             return res.status(400).json({ error: `Model ${model} not found` });
         }
         
         // 获取Azure key
-        const { key, userAgent } = await keyManager.getRandomKey();
+        const { headers } = await keyManager.getRandomKey();
         
         // 处理图片生成模型
         if (modelInfo.image === true) {
@@ -362,18 +584,14 @@ app.post('/v1/chat/completions', authenticate, async (req, res) => {
             const prompt = lastUserMessage.content;
             
             // 请求图片生成
-            const response = await axios.post(
+            const response = await upstream.post(
                 `${BASE_URL}/api/Azure/images/generations`,
                 {
                     model: model,
                     prompt: prompt
                 },
                 {
-                    headers: {
-                        'Content-Type': 'application/json',
-                        'Authorization': `Bearer ${key}`,
-                        'User-Agent': userAgent
-                    },
+                    headers,
                     timeout: 60000
                 }
             );
@@ -384,7 +602,7 @@ app.post('/v1/chat/completions', authenticate, async (req, res) => {
             // 格式化响应内容
             const content = `## 图片已生成成功\n### 提示词如下：${prompt}\n### 绘图模型：${model}\n### 绘图结果如下：\n![${prompt}](${imageUrl})`;
             
-            const messageId = `chatcmpl-${crypto.randomBytes(16).toString('hex')}`;
+            const messageId = generateId();
             const timestamp = Math.floor(Date.now() / 1000);
             
             if (stream) {
@@ -393,38 +611,16 @@ app.post('/v1/chat/completions', authenticate, async (req, res) => {
                 res.setHeader('Cache-Control', 'no-cache');
                 res.setHeader('Connection', 'keep-alive');
                 
+                // 公共字段只序列化一次，两个数据块共用
+                const chunkHead = `data: {"id":${JSON.stringify(messageId)},"object":"chat.completion.chunk","created":${timestamp},"model":${JSON.stringify(model)}`;
+                
                 // 发送开始块
-                res.write(`data: ${JSON.stringify({
-                    id: messageId,
-                    object: 'chat.completion.chunk',
-                    created: timestamp,
-                    model: model,
-                    choices: [{
-                        index: 0,
-                        delta: { role: 'assistant', content: content },
-                        finish_reason: null
-                    }]
-                })}\n\n`);
+                res.write(`${chunkHead},"choices":[{"index":0,"delta":{"role":"assistant","content":${JSON.stringify(content)}},"finish_reason":null}]}\n\n`);
                 
                 // 发送结束块
-                res.write(`data: ${JSON.stringify({
-                    id: messageId,
-                    object: 'chat.completion.chunk',
-                    created: timestamp,
-                    model: model,
-                    choices: [{
-                        index: 0,
-                        delta: { content: '' },
-                        finish_reason: 'stop'
-                    }],
-                    usage: {
-                        prompt_tokens: 0,
-                        completion_tokens: 0,
-                        total_tokens: 0
-                    }
-                })}\n\n`);
+                res.write(chunkHead + SSE_STOP_TAIL);
                 
-                res.write('data: [DONE]\n\n');
+                res.write(SSE_DONE);
                 res.end();
             } else {
                 // 非流式响应
@@ -458,108 +654,61 @@ app.post('/v1/chat/completions', authenticate, async (req, res) => {
                 res.setHeader('Cache-Control', 'no-cache');
                 res.setHeader('Connection', 'keep-alive');
                 
-                const response = await axios.post(
+                const response = await upstream.post(
                     targetUrl,
-                    req.body,
+                    req.rawBody,
                     {
-                        headers: {
-                            'Content-Type': 'application/json',
-                            'Authorization': `Bearer ${key}`,
-                            'User-Agent': userAgent
-                        },
+                        headers,
                         responseType: 'stream',
                         timeout: 60000
                     }
                 );
                 
-                let buffer = '';
-                
-                response.data.on('data', (chunk) => {
-                    buffer += chunk.toString();
-                    const lines = buffer.split('\n');
-                    buffer = lines.pop() || '';
+                if (modelInfo.audio === true) {
+                    // 音频模型需要改写媒体链接，按完整行处理
+                    let buffer = '';
+                    response.data.setEncoding('utf8');
                     
-                    for (const line of lines) {
-                        if (line.trim()) {
-                            // 处理 SSE 格式
-                            if (line.startsWith('data: ')) {
-                                const data = line.substring(6);
-                                
-                                // 处理 [DONE] 标记
-                                if (data === '[DONE]') {
-                                    res.write('data: [DONE]\n\n');
-                                    continue;
-                                }
-                                
-                                try {
-                                    const json = JSON.parse(data);
-                                    
-                                    // 处理音频模型的媒体链接
-                                    if (modelInfo.audio === true && json.choices) {
-                                        json.choices = json.choices.map(choice => {
-                                            if (choice.delta && choice.delta.content) {
-                                                choice.delta.content = processMediaLinks(choice.delta.content);
-                                            }
-                                            return choice;
-                                        });
-                                    }
-                                    
-                                    res.write(`data: ${JSON.stringify(json)}\n\n`);
-                                } catch (e) {
-                                    // 如果解析失败，原样输出
-                                    res.write(line + '\n');
-                                }
-                            } else {
-                                res.write(line + '\n');
-                            }
+                    response.data.on('data', (chunk) => {
+                        buffer += chunk;
+                        const end = buffer.lastIndexOf('\n') + 1;
+                        if (end > 0) {
+                            res.write(rewriteSseMedia(buffer.substring(0, end)));
+                            buffer = buffer.substring(end);
                         }
-                    }
-                });
-                
-                response.data.on('end', () => {
-                    if (buffer.trim()) {
-                        if (buffer.startsWith('data: ')) {
-                            const data = buffer.substring(6);
-                            if (data === '[DONE]') {
-                                res.write('data: [DONE]\n\n');
-                            } else {
-                                try {
-                                    const json = JSON.parse(data);
-                                    if (modelInfo.audio === true && json.choices) {
-                                        json.choices = json.choices.map(choice => {
-                                            if (choice.delta && choice.delta.content) {
-                                                choice.delta.content = processMediaLinks(choice.delta.content);
-                                            }
-                                            return choice;
-                                        });
-                                    }
-                                    res.write(`data: ${JSON.stringify(json)}\n\n`);
-                                } catch (e) {
-                                    res.write(buffer + '\n');
-                                }
-                            }
-                        } else {
-                            res.write(buffer + '\n');
+                    });
+                    
+                    response.data.on('end', () => {
+                        if (buffer) {
+                            res.write(rewriteSseMedia(buffer));
                         }
-                    }
-                    res.end();
-                });
-                
-                response.data.on('error', (error) => {
-                    console.error('Stream error:', error);
-                    res.end();
-                });
+                        res.end();
+                    });
+                    
+                    response.data.on('error', (error) => {
+                        console.error('Stream error:', error);
+                        res.end();
+                    });
+                    
+                    // 客户端断开时中止上游请求，不再继续读取和写入
+                    res.on('close', () => {
+                        response.data.destroy();
+                    });
+                } else {
+                    // 普通模型直接转发原始字节，客户端断开时 pipeline 会销毁上游流
+                    pipeline(response.data, res, (error) => {
+                        if (error && error.code !== 'ERR_STREAM_PREMATURE_CLOSE') {
+                            console.error('Stream error:', error.message);
+                        }
+                    });
+                }
             } else {
                 // 非流式转发
-                const response = await axios.post(
+                const response = await upstream.post(
                     targetUrl,
-                    req.body,
+                    req.rawBody,
                     {
-                        headers: {
-                            'Content-Type': 'application/json',
-                            'Authorization': `Bearer ${key}`,
-                            'User-Agent': userAgent
-                        },
+                        headers,
                         timeout: 60000
                     }
                 );
@@ -599,21 +748,17 @@ app.post('/v1/images/generations', authenticate, async (req, res) => {
         }
         
         // 获取Azure key
-        const { key, userAgent } = await keyManager.getRandomKey();
+        const { headers } = await keyManager.getRandomKey();
         
         // 请求图片生成
-        const response = await axios.post(
+        const response = await upstream.post(
             `${BASE_URL}/api/Azure/images/generations`,
             {
                 model: model,
                 prompt: prompt
             },
             {
-                headers: {
-                    'Content-Type': 'application/json',
-                    'Authorization': `Bearer ${key}`,
-                    'User-Agent': userAgent
-                },
+                headers,
                 timeout: 60000
             }
         );
@@ -660,11 +805,19 @@ app.use((err, req, res, next) => {
 async function start() {
     try {
         await initDatabase();
+        await keyManager.loadKeys();
         
         // 预先生成一些keys
         console.log('Pre-generating Azure keys...');
         await keyManager.ensureKeys();
         
+        // 定期在后台提前替换即将过期的keys，请求无需等待生成
+        setInterval(() => {
+            keyManager.renewKeys().catch(error => {
+                console.error('Failed to refill Azure keys:', error.message);
+            });
+        }, KEY_RENEW_INTERVAL_MS);
+        
         app.listen(PORT, '0.0.0.0', () => {
             console.log(`Server running on port ${PORT}`);
             console.log(`Base URL: ${BASE_URL}`);
@@ -680,21 +833,77 @@ async function start() {
     }
 }
 
+// 多进程模式下主进程只负责管理工作进程
+const isPrimary = WORKERS > 1 && !cluster.isWorker;
+let liveWorkers = 0;
+let shuttingDown = false;
+
 // 优雅关闭
-process.on('SIGTERM', async () => {
-    console.log('SIGTERM received, shutting down gracefully...');
-    if (db) {
-        await db.close();
+async function shutdown(signal) {
+    if (shuttingDown) return;
+    shuttingDown = true;
+    console.log(`${signal} received, shutting down gracefully...`);
+    
+    if (isPrimary) {
+        // 转发信号给工作进程，等它们各自关闭数据库后主进程再退出
+        if (liveWorkers === 0) process.exit(0);
+        for (const worker of Object.values(cluster.workers)) {
+            worker.process.kill(signal);
+        }
+        return;
     }
+    
+    httpAgent.destroy();
+    httpsAgent.destroy();
+    await closeDatabase();
     process.exit(0);
-});
+}
 
-process.on('SIGINT', async () => {
-    console.log('SIGINT received, shutting down gracefully...');
-    if (db) {
-        await db.close();
-    }
-    process.exit(0);
-});
+process.on('SIGTERM', () => shutdown('SIGTERM'));
+process.on('SIGINT', () => shutdown('SIGINT'));
+
+function forkWorker() {
+    const worker = cluster.fork();
+    let listening = false;
+    liveWorkers++;
+    
+    worker.on('listening', () => {
+        listening = true;
+    });
+    
+    worker.on('exit', (code, signal) => {
+        liveWorkers--;
+        
+        if (shuttingDown) {
+            if (liveWorkers === 0) process.exit(0);
+            return;
+        }
+        
+        // 启动阶段失败（如数据库被锁、端口被占用）重启也无济于事
+        if (!listening) {
+            console.error(`Worker ${worker.process.pid} failed to start (${signal || code}), not restarting`);
+            if (liveWorkers === 0) process.exit(1);
+            return;
+        }
+        
+        if (worker.exitedAfterDisconnect || (!signal && code === 0)) {
+            console.log(`Worker ${worker.process.pid} exited`);
+            return;
+        }
+        
+        console.error(`Worker ${worker.process.pid} exited (${signal || code}), restarting in ${WORKER_RESTART_DELAY_MS}ms...`);
+        setTimeout(() => {
+            if (!shuttingDown) forkWorker();
+        }, WORKER_RESTART_DELAY_MS);
+    });
+}
 
-start();
+// 多进程模式下由主进程启动工作进程，共享同一个端口
+if (isPrimary) {
+    console.log(`Starting ${WORKERS} workers...`);
+    for (let i = 0; i < WORKERS; i++) {
+        forkWorker();
+    }
+} else {
+    start();
+}